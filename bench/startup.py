@@ -0,0 +1,57 @@
+"""
+Measures the CLI startup time and reports the slowest imports.
+
+The command is started several times with --version and the median wall time is compared to the
+target. An import-time profile of the same command lists the modules with the highest cumulative
+import time. Run it from the repository root:
+
+    python bench/startup.py [runs]
+"""
+
+import os, subprocess, sys, time, statistics
+
+fats_init = os.path.realpath(os.path.join(os.path.dirname(__file__), '..', 'src', 'fats_init.py'))
+command = [sys.executable, fats_init, '--version']
+target = 0.1
+top = 15
+
+
+def wall_times(runs):
+    "Wall times of starting the command runs times."
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def import_profile():
+    "Returns (cumulative us, self us, module) tuples parsed from python -X importtime."
+    res = subprocess.run([sys.executable, '-X', 'importtime'] + command[1:],
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    profile = []
+    for line in res.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        profile.append((int(cumulative_us), int(self_us), module.rstrip()))
+    return profile
+
+
+def main(runs=10):
+    times = wall_times(runs)
+    median = statistics.median(times)
+    print("--version median of {} runs: {:.1f} ms (min {:.1f} ms, target {:.0f} ms) {}".format(
+        runs, median * 1e3, min(times) * 1e3, target * 1e3, 'OK' if median < target else 'SLOW'))
+
+    print("\nSlowest imports by cumulative time:")
+    print("{:>10} {:>10}  module".format('cum [ms]', 'self [ms]'))
+    for cumulative_us, self_us, module in sorted(import_profile(), reverse=True)[:top]:
+        print("{:>10.1f} {:>10.1f} {}".format(cumulative_us / 1e3, self_us / 1e3, module))
+
+    return 0 if median < target else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(*(int(a) for a in sys.argv[1:])))
@@ -0,0 +1,75 @@
+"""
+Reports the peak RSS per in-flight TradeBlock.
+
+Synthetic Kraken responses are parsed into TradeBlocks which are all kept alive, like the blocks
+in flight across many markets. Two states are measured, each in its own process:
+
+    backfill -- full blocks continuing the trade cache, written to temporary cache files
+    tail -- blocks which aren't cached
+
+Run it from the repository root:
+
+    PYTHONPATH=src python bench/trade_block_memory.py [blocks [case]]
+"""
+
+import resource, sys, random, tempfile, subprocess
+import fatstack as fs
+import fatstack.collector as collector
+from fatstack.exchanges.kraken import KRAKEN
+from fatstack.instruments.eth import ETH
+from fatstack.instruments.btc import BTC
+
+
+def synthetic_block(api_name, start, length):
+    "A Trades response of the Kraken API with length trades starting at start."
+    trades = []
+    for i in range(length):
+        trades.append(["{:.5f}".format(random.uniform(0.01, 0.1)),
+                       "{:.8f}".format(random.uniform(0.001, 100)),
+                       start + i * 0.25,
+                       random.choice('bs'),
+                       random.choice('ml'),
+                       ""])
+    return {'error': [], 'result': {api_name: trades, 'last': str(int((start + length) * 1e9))}}
+
+
+def peak_rss():
+    "Peak resident set size of the process in kilobytes."
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(blocks, case):
+    collector.trade_cache = tempfile.mkdtemp()
+    exchange = KRAKEN()
+    market = fs.core.Market(exchange, ETH(), BTC(), 'XETHXXBT')
+    market.last_cached_trade_id = '0'
+    # Nothing waiting to be cached makes every full block cacheable.
+    market.not_cached = 0 if case == 'backfill' else 1
+    market.trade_window = collector.TradeWindow()
+
+    # Responses are generated one at a time, so only the parsed blocks accumulate.
+    base = peak_rss()
+    in_flight = []
+    for n in range(blocks):
+        start = 1.5e9 + n * exchange.trade_block_len
+        trade_block = collector.TradeBlock(market, str(int(start * 1e9)))
+        trade_block.json_block = synthetic_block(market.api_name, start, exchange.trade_block_len)
+        trade_block.parse()
+        in_flight.append(trade_block)
+
+    peak = peak_rss()
+    print("{}: {} blocks of {} trades in flight.".format(case, blocks, exchange.trade_block_len))
+    print("Peak RSS: {} kB, {:.1f} kB per block.".format(peak, (peak - base) / blocks))
+
+
+def main(blocks=200, case=None):
+    if case:
+        measure(int(blocks), case)
+        return
+    # Peak RSS never decreases, so every case needs a fresh process.
+    for case in ('backfill', 'tail'):
+        subprocess.run([sys.executable, __file__, str(blocks), case], check=True)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -2,16 +2,406 @@
 The brain translates trades stored in the collector database into timeframes. A timeframe is similar
 to a candle but it stores a bit more data about the trades in thet interval. Notably it stores the
 linear regression against the log10 value of price.
+
+Rolling analytics over the last n timeframes are computed from window sums. The rolling_*
+functions compute them for a whole history at once, a RollingWindow updates them in O(1) for every
+new timeframe. Prices are log10 prices, standard deviations are population ones, and the first
+n - 1 values of a history are NaN.
+
+Panels align a timeframe field of several markets on common intervals for cross-market analysis.
 """
 
 import fatstack as fs
-import logging, sys
-# import time
+import logging, sys, collections, math, asyncio, datetime
+import numpy as np
 
 brain = sys.modules[__name__]
 log = logging.getLogger(__name__)
 
+# Connection pool to the collector database, created on first use.
+db = None
+db_lock = asyncio.Lock()
+
 
 def init():
     log.info("Initializing the brain.")
     fs.ROOT.Sys.brain = brain
+
+
+# Rolling analytics
+
+
+class RollingWindow:
+    """
+    Rolling statistics of the last n timeframes of a market. Every push adds the newest timeframe
+    and removes the oldest one from the window sums.
+
+    The price sums are taken relative to an anchor price close to the window, so the variances
+    don't lose their precision to the magnitude of the prices.
+    """
+
+    def __init__(self, n):
+        _check_window(n)
+        self.n = n
+        # Sums of x and x^2 over the positions 0..n-1 of a full window.
+        self.sx = n * (n - 1) / 2
+        self.sxx = (n - 1) * n * (2 * n - 1) / 6
+
+        self.prices = collections.deque()
+        self.volumes = collections.deque()
+        self.returns = collections.deque()
+        self.pushes = 0
+        self.resum()
+
+    def resum(self):
+        """
+        Moves the anchor to the window mean and recomputes the window sums from the window. Runs
+        every n pushes to stop the rounding errors of the updates from accumulating, which keeps
+        the updates O(1) amortized.
+        """
+        self.anchor = math.fsum(self.prices) / len(self.prices) if self.prices else None
+        deltas = [p - self.anchor for p in self.prices]
+        self.sd = math.fsum(deltas)
+        self.sdd = math.fsum(d * d for d in deltas)
+        self.sxd = math.fsum(x * d for x, d in enumerate(deltas))
+        self.sv = math.fsum(self.volumes)
+        self.svd = math.fsum(v * d for v, d in zip(self.volumes, deltas))
+        self.svdd = math.fsum(v * d * d for v, d in zip(self.volumes, deltas))
+        self.sr = math.fsum(self.returns)
+        self.srr = math.fsum(r * r for r in self.returns)
+
+    def push(self, price, volume):
+        "Adds a timeframe with the given log10 price and volume."
+        if self.anchor is None:
+            self.anchor = price
+        if self.prices:
+            r = price - self.prices[-1]
+            self.returns.append(r)
+            self.sr += r
+            self.srr += r * r
+
+        if len(self.prices) == self.n:
+            d = self.prices.popleft() - self.anchor
+            v = self.volumes.popleft()
+            r = self.returns.popleft()
+            self.sd -= d
+            self.sdd -= d * d
+            # The remaining timeframes move one position to the left.
+            self.sxd -= self.sd
+            self.sv -= v
+            self.svd -= v * d
+            self.svdd -= v * d * d
+            self.sr -= r
+            self.srr -= r * r
+
+        d = price - self.anchor
+        self.sxd += len(self.prices) * d
+        self.prices.append(price)
+        self.volumes.append(volume)
+        self.sd += d
+        self.sdd += d * d
+        self.sv += volume
+        self.svd += volume * d
+        self.svdd += volume * d * d
+
+        self.pushes += 1
+        if self.pushes % self.n == 0:
+            self.resum()
+
+    def is_full(self):
+        return len(self.prices) == self.n
+
+    def slope(self):
+        "Slope of the linear regression of price per timeframe."
+        if not self.is_full():
+            return math.nan
+        n = self.n
+        return (n * self.sxd - self.sx * self.sd) / (n * self.sxx - self.sx * self.sx)
+
+    def volatility(self):
+        "Standard deviation of the price changes between the timeframes."
+        if not self.is_full():
+            return math.nan
+        n = self.n - 1
+        return _std(self.sr / n, self.srr / n)
+
+    def vwap(self):
+        "Volume weighted average price."
+        if not self.is_full() or self.sv <= 0:
+            return math.nan
+        return self.svd / self.sv + self.anchor
+
+    def vw_std(self):
+        "Volume weighted standard deviation of price."
+        if not self.is_full() or self.sv <= 0:
+            return math.nan
+        return _std(self.svd / self.sv, self.svdd / self.sv)
+
+    def zscore(self):
+        "Distance of the newest price from the window mean in standard deviations."
+        if not self.is_full():
+            return math.nan
+        mean = self.sd / self.n
+        std = _std(mean, self.sdd / self.n)
+        if _is_flat(std, mean + self.anchor):
+            return math.nan
+        return (self.prices[-1] - self.anchor - mean) / std
+
+
+# Below this standard deviation relative to the price a window is flat and has no z-score. Empty
+# timeframes are forward filled, so flat windows are common and only show rounding noise.
+flat_tolerance = 1e-7
+
+
+def _is_flat(std, mean):
+    return std <= flat_tolerance * np.maximum(np.abs(mean), 1.0)
+
+
+def _check_window(n):
+    if n < 2:
+        raise ValueError("A rolling window needs at least 2 timeframes.")
+
+
+def _std(mean, mean_of_squares):
+    # Rounding can make the variance slightly negative.
+    return math.sqrt(max(mean_of_squares - mean * mean, 0.0))
+
+
+def _segments(length, n):
+    """
+    Splits the windows of a history of length values into segments of O(n) windows. Yields the
+    first value, the first window end and the last window end + 1 of every segment.
+
+    The batch functions compute every segment from cumulative sums of its values centered on their
+    mean. Restarting the sums every segment keeps the rounding error independent of the length of
+    the history, and time and memory O(length).
+    """
+    step = max(4 * n, 4096)
+    for start in range(n - 1, length, step):
+        yield start - n + 1, start, min(start + step, length)
+
+
+def _moving_sums(a, n):
+    "Sums of every window of n consecutive values of a."
+    c = np.concatenate(([0.0], np.cumsum(a)))
+    return c[n:] - c[:-n]
+
+
+def _centered(a):
+    return a - a.mean(), a.mean()
+
+
+def rolling_slope(price, n):
+    "Slope of the linear regression of price per timeframe over every n timeframes."
+    _check_window(n)
+    price = np.asarray(price, dtype=float)
+    sx = n * (n - 1) / 2
+    sxx = (n - 1) * n * (2 * n - 1) / 6
+    res = np.full(len(price), np.nan)
+    for first, start, stop in _segments(len(price), n):
+        y, _ = _centered(price[first:stop])
+        k = np.arange(len(y), dtype=float)
+        sy = _moving_sums(y, n)
+        # Positions within the window are the ones in the segment minus the window start.
+        sxy = _moving_sums(k * y, n) - k[:len(sy)] * sy
+        res[start:stop] = (n * sxy - sx * sy) / (n * sxx - sx * sx)
+    return res
+
+
+def rolling_volatility(price, n):
+    "Standard deviation of the price changes over every n timeframes."
+    _check_window(n)
+    price = np.asarray(price, dtype=float)
+    res = np.full(len(price), np.nan)
+    if len(price) > 1:
+        res[1:] = np.sqrt(_window_mean_var(np.diff(price), n - 1)[1])
+    return res
+
+
+def rolling_vwap(price, volume, n):
+    "Volume weighted average price over every n timeframes."
+    _check_window(n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return _window_mean_var(price, n, volume)[0]
+
+
+def rolling_vw_std(price, volume, n):
+    "Volume weighted standard deviation of price over every n timeframes."
+    _check_window(n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sqrt(_window_mean_var(price, n, volume)[1])
+
+
+def rolling_zscore(price, n):
+    "Distance of every price from the mean of its window in standard deviations."
+    _check_window(n)
+    price = np.asarray(price, dtype=float)
+    mean, var = _window_mean_var(price, n)
+    std = np.sqrt(var)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(_is_flat(std, mean), np.nan, (price - mean) / std)
+
+
+def _window_mean_var(a, n, weights=None):
+    """
+    Weighted mean and variance of every window of n consecutive values, the first n - 1 are NaN.
+    """
+    a = np.asarray(a, dtype=float)
+    weights = np.ones(len(a)) if weights is None else np.asarray(weights, dtype=float)
+    mean = np.full(len(a), np.nan)
+    var = np.full(len(a), np.nan)
+    for first, start, stop in _segments(len(a), n):
+        d, center = _centered(a[first:stop])
+        w = weights[first:stop]
+        sw = _moving_sums(w, n)
+        m = _moving_sums(w * d, n) / sw
+        mean[start:stop] = m + center
+        var[start:stop] = np.maximum(_moving_sums(w * d * d, n) / sw - m * m, 0.0)
+    return mean, var
+
+
+# Cross-market panels
+
+
+# Timeframe fields. Prices are log10 prices, empty timeframes take the previous close as price and
+# zero as volume and trade count.
+price_fields = ('open', 'high', 'low', 'close', 'vwap')
+count_fields = ('volume', 'trades')
+# Fields which are prices of single trades, so a synthetic market's value derives from them.
+# Highs, lows and averages of different markets happen at different times, they don't combine.
+synthetic_fields = ('open', 'close')
+
+timeframe_query = """SELECT {index} AS market,
+                            floor(extract(epoch FROM time - $2) / $1)::int AS bucket,
+                            (array_agg(price ORDER BY time))[1] AS open,
+                            max(price) AS high,
+                            min(price) AS low,
+                            (array_agg(price ORDER BY time DESC))[1] AS close,
+                            sum(volume * price) / nullif(sum(volume), 0) AS vwap,
+                            sum(volume) AS volume,
+                            count(*) AS trades
+                       FROM {table} WHERE time >= $2 AND time < $3 GROUP BY bucket"""
+
+panel_cache = collections.OrderedDict()
+panel_cache_size = 64
+
+
+class Panel:
+    """
+    One timeframe field of several markets aligned on common intervals. values[i, j] is the field
+    of market codes[i] in the interval starting at times[j].
+    """
+
+    def __init__(self, codes, times, field, values):
+        self.codes = codes
+        self.times = times
+        self.field = field
+        self.values = values
+
+    def row(self, code):
+        "The values of the given market."
+        return self.values[self.codes.index(code)]
+
+    def synthetic(self, code, base, quote):
+        """
+        Returns a panel extended with the synthetic market code priced as base / quote, where base
+        and quote are markets sharing their quote instrument, like ETH_USD / BTC_USD for ETH_BTC.
+        """
+        if self.field not in synthetic_fields:
+            raise ValueError("Synthetic markets only have open and close prices, not {}.".format(
+                self.field))
+        # Log10 prices turn the division into a subtraction.
+        row = self.row(base) - self.row(quote)
+        return Panel(self.codes + (code,), self.times, self.field, np.vstack((self.values, row)))
+
+    def __repr__(self):
+        return "<Panel field: {}, markets: {}, intervals: {}>".format(
+            self.field, len(self.codes), len(self.times))
+
+
+async def get_panel(markets, field, interval, start, stop):
+    """
+    Returns the panel of the field for the markets over the intervals of interval seconds between
+    start and stop, naive UTC datetimes like the trade times. The timeframes of every field are
+    cached by (markets, interval, range), the least recently used ones are evicted first. Ranges
+    ending in the future still get new trades, so they aren't cached.
+    """
+    if field not in price_fields + count_fields:
+        raise ValueError("Not a timeframe field: {} .".format(field))
+    if stop <= start:
+        raise ValueError("Empty range: {} - {} .".format(start, stop))
+    if interval <= 0:
+        raise ValueError("Not a valid interval: {} .".format(interval))
+    codes = tuple(str(m) for m in markets)
+    key = (codes, interval, start, stop)
+
+    if key in panel_cache:
+        panel_cache.move_to_end(key)
+        times, fields = panel_cache[key]
+    else:
+        times, fields = await fetch_timeframes(codes, interval, start, stop)
+        if stop <= datetime.datetime.utcnow():
+            panel_cache[key] = times, fields
+            if len(panel_cache) > panel_cache_size:
+                panel_cache.popitem(last=False)
+
+    return Panel(codes, times, field, fields[field])
+
+
+async def fetch_timeframes(codes, interval, start, stop):
+    """
+    Fetches the timeframes of the markets with one query and aligns every field in one pass.
+    Returns the interval start times and a dict of read-only (market, interval) arrays by field.
+    """
+    async with brain.db_lock:
+        if brain.db is None:
+            db = fs.core.Database(fs.ROOT.Config.collector_database, None)
+            db.pool = await db.create_pool()
+            # Only published once usable, concurrent callers wait on the lock.
+            brain.db = db
+
+    query = ' UNION ALL '.join(timeframe_query.format(index=i, table=code.lower())
+                               for i, code in enumerate(codes))
+    async with brain.db.pool.acquire() as con:
+        rows = await con.fetch(query, float(interval), start, stop)
+
+    n = math.ceil((stop - start).total_seconds() / interval)
+    times = np.datetime64(start) + np.arange(n) * np.timedelta64(int(interval * 1e6), 'us')
+    return times, align_timeframes(rows, len(codes), n)
+
+
+def align_timeframes(rows, markets, intervals):
+    """
+    Scatters timeframe rows into (market, interval) arrays of every field and fills the gaps.
+    """
+    fields = price_fields + count_fields
+    data = np.array([[r['market'], r['bucket']] + [r[f] for f in fields] for r in rows],
+                    dtype=float).reshape(-1, 2 + len(fields))
+    market = data[:, 0].astype(int)
+    bucket = data[:, 1].astype(int)
+
+    aligned = {}
+    for i, f in enumerate(fields):
+        values = np.full((markets, intervals), np.nan)
+        values[market, bucket] = data[:, 2 + i]
+        aligned[f] = values
+
+    close = forward_fill(aligned['close'])
+    for f in price_fields:
+        values = aligned[f]
+        gaps = np.isnan(values)
+        values[gaps] = close[gaps]
+    for f in count_fields:
+        aligned[f][np.isnan(aligned[f])] = 0
+
+    for values in aligned.values():
+        # The arrays are shared by the cached panels.
+        values.setflags(write=False)
+    return aligned
+
+
+def forward_fill(values):
+    "Fills NaNs along the rows with the last preceding value. Leading NaNs are kept."
+    index = np.where(np.isnan(values), 0, np.arange(values.shape[1]))
+    np.maximum.accumulate(index, axis=1, out=index)
+    return values[np.arange(values.shape[0])[:, None], index]
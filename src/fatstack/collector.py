@@ -5,7 +5,7 @@ it to other FATStack processes.
 
 import fatstack as fs
 import fatstack.concurrency
-import logging, sys, os.path, json, asyncio
+import logging, sys, os.path, json, asyncio, collections, itertools, array, math, datetime
 
 collector = sys.modules[__name__]
 log = logging.getLogger(__name__)
@@ -15,6 +15,7 @@ class CollectorThread(fatstack.concurrency.AsyncThread):
     def register_tasks(self):
         # Connecting to the database
         self.loop.run_until_complete(collector.db.connect_or_create())
+        self.loop.run_until_complete(migrate())
         # Start syncing the markets.
         for exchange in fs.ROOT.Config.exchanges:
             self.loop.run_until_complete(
@@ -25,8 +26,19 @@ class CollectorThread(fatstack.concurrency.AsyncThread):
 class TradeBlock:
     """
     One chunk of data retrieved from an exchange server.
+
+    The raw block is released once parsed. A block going into the trade cache is written to a
+    temporary file first, which is moved into the cache after the trades are stored. The trades
+    are kept in compact columns: price, volume and time (unix timestamp) as doubles, buy and limit
+    as bytes.
     """
 
+    __slots__ = ('market', 'from_trade_id', 'from_time', 'cache_file', 'loaded_from_disk',
+                 'cacheable', 'json_block', 'last', 'size', 'overlap',
+                 'price', 'volume', 'time', 'buy', 'limit')
+
+    columns = ('price', 'volume', 'time', 'buy', 'limit')
+
     def __init__(self, market, from_trade_id):
         self.market = market
         self.from_trade_id = from_trade_id
@@ -38,50 +50,108 @@ class TradeBlock:
                                        str(self.from_time.day),
                                        self.from_trade_id)
         self.loaded_from_disk = False
+        self.cacheable = False
 
         self.json_block = None
         self.last = None
-        self.json_trades = None
-        self.trades = None
+        self.size = 0
+        self.overlap = 0
+
+        self.price = array.array('d')
+        self.volume = array.array('d')
+        self.time = array.array('d')
+        self.buy = array.array('b')
+        self.limit = array.array('b')
 
     async def load_json(self):
         if os.path.isfile(self.cache_file):
             with open(self.cache_file, 'r') as file_handler:
                 self.json_block = json.load(file_handler)
-            log.info("Found {} in cache.".format(self.cache_file))
+            self.market.log.info("Found %s in cache.", self.cache_file)
             self.loaded_from_disk = True
         else:
             self.json_block = await self.market.exchange.fetch_trade_block(self)
-            log.info("Fetched from exchange from {}.".format(self.from_time))
+            self.market.log.info("Fetched from exchange from %s.", self.from_time)
+
+        self.parse()
 
+    def parse(self):
+        """
+        Parses the raw block into the columns, releases it and drops the trades already stored.
+        """
         self.market.exchange.get_trades_from_json(self)
 
+        self.cacheable = not self.loaded_from_disk and self.is_cacheable()
+        if self.cacheable:
+            self.dump_json()
+        self.json_block = None
+
+        self.overlap = self.market.trade_window.overlap(self.fingerprints())
+        if self.overlap:
+            for column in self.columns:
+                del getattr(self, column)[:self.overlap]
+
+    def is_cacheable(self):
+        """
+        Only full blocks continuing the cache are cached. That's the case if nothing is waiting to
+        be cached or the block starts where the cache ends.
+        """
+        return (self.size == self.market.exchange.trade_block_len and
+                (self.market.not_cached == 0 or
+                 self.from_trade_id == self.market.last_cached_trade_id))
+
+    def fingerprints(self):
+        "Identifies the trades of the block for the trade window."
+        return zip(self.time, self.price, self.volume, self.buy, self.limit)
+
+    def records(self):
+        "The trades in the layout of the market tables."
+        return zip(map(math.log10, self.price),
+                   self.volume,
+                   map(datetime.datetime.utcfromtimestamp, self.time),
+                   map(bool, self.buy),
+                   map(bool, self.limit))
+
     async def insert_trades(self):
+        """
+        Stores the trades not stored yet. The trades, the cursor and the last stored trades are
+        written in one transaction, so a retried block never inserts a trade twice.
+        """
+        window = self.market.trade_window
+        fingerprints = list(self.fingerprints())
+        last_trades = json.dumps(window.last_group(fingerprints))
+        if self.overlap:
+            self.market.log.debug("Dropped %s already stored trades.", self.overlap)
+
         async with fs.ROOT.Sys.collector.db.pool.acquire() as con:
-            records = list(self.trades.itertuples(index=False))
             async with con.transaction():
-                await con.copy_records_to_table(self.market.code.lower(), records=records)
+                await con.copy_records_to_table(self.market.code.lower(), records=self.records())
                 await con.execute(
-                        "UPDATE market SET last_stored_trade_id = $1 WHERE code = $2",
-                        self.last, self.market.code)
+                        "UPDATE market SET last_stored_trade_id = $1, last_trades = $2 WHERE code = $3",
+                        self.last, last_trades, self.market.code)
             self.market.last_stored_trade_id = self.last
-            self.market.log.info("Inserted %s trades into %s.", len(records), self.market.code)
+            window.push(fingerprints)
+            self.market.log.info("Inserted %s trades into %s.", len(self), self.market.code)
 
     async def cache(self):
+        """
+        Runs after the trades are stored, so only blocks whose trades are in the database get into
+        the trade cache.
+        """
         if not self.loaded_from_disk:
-            if len(self.json_trades) == self.market.exchange.trade_block_len and self.market.not_cached == 0:
-                self.dump_json()
+            if self.save():
                 await self.update_last_cached_id(self.last)
             else:
-                self.market.not_cached += len(self.json_trades)
+                self.market.not_cached += self.size
                 if self.market.not_cached >= self.market.exchange.trade_block_len:
                     large_trade_block = TradeBlock(self.market, self.market.last_cached_trade_id)
-                    large_trade_block.load_json()
-                    large_trade_block.dump_json()
-                    await self.update_last_cached_id(large_trade_block.last)
-                    self.market.not_cached -= self.len(large_trade_block.json_trades)
-
-            log.info("Saved {} .".format(self.cache_file))
+                    try:
+                        await large_trade_block.load_json()
+                        if large_trade_block.save():
+                            await self.update_last_cached_id(large_trade_block.last)
+                            self.market.not_cached -= large_trade_block.size
+                    finally:
+                        large_trade_block.discard()
 
     async def update_last_cached_id(self, last_cached_id):
         self.market.last_cached_trade_id = last_cached_id
@@ -90,12 +160,35 @@ class TradeBlock:
                     "UPDATE market SET last_cached_trade_id = $1 WHERE code = $2",
                     last_cached_id, self.market.code)
 
+    def save(self):
+        """
+        Moves the temporary file of a cacheable block into the trade cache. Returns True if the
+        block is in the trade cache, which is also the case if it was loaded from there.
+        """
+        if self.cacheable:
+            os.replace(self.tmp_file, self.cache_file)
+            self.market.log.info("Saved %s .", self.cache_file)
+        return self.cacheable or self.loaded_from_disk
+
+    def discard(self):
+        "Removes the temporary file of a block which didn't make it into the trade cache."
+        if self.cacheable and os.path.isfile(self.tmp_file):
+            os.remove(self.tmp_file)
+
     def dump_json(self):
+        "Writes the raw block to the temporary file."
         if not os.path.isdir(os.path.dirname(self.cache_file)):
             os.makedirs(os.path.dirname(self.cache_file))
-        with open(self.cache_file, 'w') as file_handler:
+        with open(self.tmp_file, 'w') as file_handler:
             json.dump(self.json_block, file_handler)
 
+    @property
+    def tmp_file(self):
+        return self.cache_file + '.tmp'
+
+    def __len__(self):
+        return len(self.price)
+
     def __repr__(self):
         return "<TradeBlock market: {}, from_trade_id: {}, from_time: {}>".format(
             self.market.code,
@@ -103,6 +196,67 @@ class TradeBlock:
             self.from_time)
 
 
+class TradeWindow:
+    """
+    The newest stored trades of a market. Trade blocks can overlap with the trades already stored,
+    the window tells how many trades to drop from the start of a block.
+
+    Trades are identified by their fingerprint, a (time, price, volume, buy, limit) tuple. Stored
+    trades are ordered by time, so only the newest group of simultaneous trades has to be kept:
+    older trades are known to be stored without looking them up.
+    """
+
+    def __init__(self):
+        self.group = []
+        self.counts = collections.Counter()
+
+    def seed(self, fingerprints):
+        "Resets the window to the given fingerprints of the last stored trades."
+        self.group = list(fingerprints)
+        self.counts = collections.Counter(self.group)
+
+    def overlap(self, fingerprints):
+        """
+        Returns the number of trades at the start of fingerprints which are already stored. Blocks
+        are ordered by time, so the overlap is always a prefix of the block.
+        """
+        if not self.group:
+            return 0
+        newest = self.group[0][0]
+
+        seen = collections.Counter()
+        n = 0
+        for fingerprint in fingerprints:
+            # Most blocks start after the last stored trade, so this stops at the first trade.
+            if fingerprint[0] > newest:
+                break
+            if fingerprint[0] == newest:
+                # Identical trades can happen at the same time, so they are counted.
+                if seen[fingerprint] == self.counts[fingerprint]:
+                    break
+                seen[fingerprint] += 1
+            n += 1
+        return n
+
+    def push(self, fingerprints):
+        "Adds the fingerprints of newly stored trades to the window."
+        self.seed(self.last_group(fingerprints))
+
+    def last_group(self, fingerprints=()):
+        """
+        Returns the newest trades sharing the same time, as if fingerprints were pushed to the
+        window. This is persisted to seed the window on restart.
+        """
+        newest = itertools.chain(reversed(fingerprints), reversed(self.group))
+        group = []
+        for fingerprint in newest:
+            if group and fingerprint[0] != group[0][0]:
+                break
+            group.append(fingerprint)
+        group.reverse()
+        return group
+
+
 def bind():
     log.info("Initializing the collector.")
 
@@ -113,7 +267,8 @@ def bind():
           code VARCHAR(16) PRIMARY KEY,
           last_stored_trade_id TEXT,
           last_cached_trade_id TEXT,
-          not_cached INT)"""
+          not_cached INT,
+          last_trades TEXT)"""
 
     collector.db = fs.core.Database(fs.ROOT.Config.collector_database, init_query)
 
@@ -123,6 +278,20 @@ def bind():
     fs.ROOT.Sys.collector = collector
 
 
+async def migrate():
+    """
+    Brings databases created by older versions up to date. The schema is only altered if needed,
+    as ALTER TABLE locks the market table.
+    """
+    # Databases created before trade deduplication lack the last_trades column.
+    res = await collector.db.fetchrow("""SELECT 1 FROM information_schema.columns
+                                          WHERE table_name = 'market'
+                                            AND column_name = 'last_trades';""")
+    if not res:
+        log.info("Adding the last_trades column to the market table.")
+        await collector.db.execute("ALTER TABLE market ADD COLUMN last_trades TEXT;")
+
+
 def sync_all_markets(exchange):
     """
     Starts tracking the markets on the given exchange.
@@ -130,7 +299,7 @@ def sync_all_markets(exchange):
 
     exchange.track = True
     for market in exchange.markets:
-        log.info("Started syncing {} .".format(market))
+        log.info("Started syncing %s .", market)
         asyncio.ensure_future(sync_market(market))
 
 
@@ -147,3 +316,23 @@ async def sync_market(market):
 
         except Exception as e:
             market.log.error(repr(e))
+            trade_block.discard()
+            # The insert may have been committed before the error, so the cursor and the trade
+            # window are reloaded before the block is retried.
+            await reload_sync_state(market)
+
+
+async def reload_sync_state(market):
+    """
+    Reloads the sync state of the market, retrying with an exponential backoff until it succeeds.
+    Fetching with a stale cursor could store a committed block again.
+    """
+    delay = 1
+    while True:
+        try:
+            await market.load_sync_state()
+            return
+        except Exception as e:
+            market.log.error("Reloading sync state failed, retrying in %s s: %r", delay, e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
@@ -90,6 +90,16 @@ def create_cli_parser():
     parser.add_argument('-l', '--log-file',
                         default="fatstack.log",
                         help="log file name", metavar='FILE')
+    parser.add_argument('--log-max-bytes', type=int, default=10 * 1024 * 1024,
+                        help="size of the log file before it's rotated", metavar='BYTES')
+    parser.add_argument('--log-backups', type=int, default=5,
+                        help="number of rotated log files kept", metavar='N')
+    parser.add_argument('--market-log-rate', type=float, default=1.0,
+                        help="sustained rate of the same info message per market per second",
+                        metavar='RATE')
+    parser.add_argument('--market-log-burst', type=int, default=10,
+                        help="number of the same info message per market let through at once",
+                        metavar='N')
     parser.add_argument('-c', '--config-file',
                         default="fatstack_config.py",
                         help="config file name", metavar='FILE')
@@ -126,6 +136,8 @@ def create_cli_parser():
                         help="The collector's database connection string.")
     parser.add_argument('--trade-cache', default='trade_cache',
                         help="Trade cache directory name.")
+    parser.add_argument('--market-cache-ttl', type=int, default=86400,
+                        help="Seconds to reuse the cached market list of exchanges.")
 
     # Database arguments
     parser.add_argument('--admin-database', default='postgres',
@@ -1,5 +1,5 @@
 import logging, logging.handlers
-import os, asyncpg
+import os, json, time, queue, atexit
 
 import fatstack as fs
 
@@ -8,10 +8,70 @@ log = logging.getLogger(__name__)
 stderr_handler = logging.StreamHandler()
 mem_handler = logging.handlers.MemoryHandler(100)
 final_log_format = '%(asctime)s %(levelname).1s %(name)s: %(message)s'
+log_listener = None
 
 # Logging related functions
 
 
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on the queue without formatting them. The listener thread formats and writes
+    them, so logging only costs an enqueue for the caller. The arguments of a record are formatted
+    later, so they shouldn't be mutated after logging.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Rate limits the records below WARNING by logger and message with token buckets. A bucket
+    allows burst records at once and refills at rate records per second. The first record let
+    through after suppression carries the number of suppressed ones in its suppressed attribute.
+    """
+
+    def __init__(self, rate=1.0, burst=10):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+
+        key = (record.name, record.msg)
+        tokens, last, suppressed = self.buckets.get(key, (self.burst, record.created, 0))
+        tokens = min(self.burst, tokens + (record.created - last) * self.rate)
+        if tokens < 1:
+            self.buckets[key] = (tokens, record.created, suppressed + 1)
+            return False
+
+        # Formatted by the listener, see FinalFormatter.
+        record.suppressed = suppressed
+        self.buckets[key] = (tokens - 1, record.created, 0)
+        return True
+
+
+class FinalFormatter(logging.Formatter):
+    "Formats records with final_log_format and tells about records suppressed before them."
+
+    def __init__(self):
+        super().__init__(final_log_format)
+
+    def format(self, record):
+        message = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            message += " ({} similar messages suppressed)".format(suppressed)
+        return message
+
+
+# Shared by the loggers of the markets, configured by init_logging().
+market_log_filter = RateLimitFilter()
+
+
 def bootstrap_logging():
     """
     Runs before command line arguments parsed to setup temporary logger.
@@ -29,7 +89,10 @@ def init_logging(config):
     """
     Sets up final looger now that it knows where to save the log file. Also saves
     events from temporary boot logger set up by bootstrap_logging().
+
+    The final handlers run in a listener thread, the root logger only puts records on its queue.
     """
+    global log_listener
 
     if not os.path.isdir(config.log_dir):
         log.info("Log dir %s doesn't exists, creating it.", config.log_dir)
@@ -37,18 +100,29 @@ def init_logging(config):
 
     log.info("Logging into: %s", config.log_file)
 
-    file_handler = logging.FileHandler(config.log_file)
-    final_formatter = logging.Formatter(final_log_format)
+    file_handler = logging.handlers.RotatingFileHandler(
+            config.log_file, maxBytes=config.log_max_bytes, backupCount=config.log_backups)
+    final_formatter = FinalFormatter()
     file_handler.setFormatter(final_formatter)
-    logging.root.addHandler(file_handler)
     mem_handler.setTarget(file_handler)
     mem_handler.flush()
-    logging.root.removeHandler(logging.root.handlers[1])
+    logging.root.removeHandler(mem_handler)
 
+    handlers = [file_handler]
     if config.no_shell:
         stderr_handler.setFormatter(final_formatter)
-    else:
-        logging.root.removeHandler(stderr_handler)
+        handlers.append(stderr_handler)
+    logging.root.removeHandler(stderr_handler)
+
+    market_log_filter.rate = config.market_log_rate
+    market_log_filter.burst = config.market_log_burst
+
+    log_queue = queue.SimpleQueue()
+    log_listener = logging.handlers.QueueListener(log_queue, *handlers)
+    log_listener.start()
+    # Registered after logging's own shutdown, so it runs first and flushes the queue.
+    atexit.register(log_listener.stop)
+    logging.root.addHandler(LazyQueueHandler(log_queue))
 
 
 # Tree objects
@@ -84,6 +158,8 @@ class Tree(Node):
 class Instrument:
     "A financial instrument that you can work with in FATStack."
 
+    __slots__ = ('code', 'name')
+
     def __str__(self):
         return self.code
 
@@ -97,6 +173,8 @@ class Pair:
     a market.
     """
 
+    __slots__ = ('base', 'quote', 'code')
+
     def __init__(self, base, quote):
         self.base = base
         self.quote = quote
@@ -120,6 +198,32 @@ class Exchange(Node):
     async def add_common_markets(self, instruments):
         self.markets = await self.get_markets(instruments)
 
+    async def cached_query(self, name, query):
+        """
+        Returns the JSON response of the query coroutine function. The response is cached in the
+        var directory and reused for market_cache_ttl seconds.
+        """
+        cache_file = os.path.join(fs.ROOT.Config.var_path, 'cache',
+                                  '{}_{}.json'.format(self.code.lower(), name))
+        if os.path.isfile(cache_file):
+            age = time.time() - os.path.getmtime(cache_file)
+            if age < fs.ROOT.Config.market_cache_ttl:
+                try:
+                    with open(cache_file, 'r') as file_handler:
+                        return json.load(file_handler)
+                except json.JSONDecodeError:
+                    log.warning("Cache file %s is corrupt, querying the exchange.", cache_file)
+
+        res = await query()
+        if not os.path.isdir(os.path.dirname(cache_file)):
+            os.makedirs(os.path.dirname(cache_file))
+        # The file is replaced at once, so an interrupted write can't leave a truncated cache.
+        tmp_file = cache_file + '.tmp'
+        with open(tmp_file, 'w') as file_handler:
+            json.dump(res, file_handler)
+        os.replace(tmp_file, cache_file)
+        return res
+
     def __str__(self):
         return self.code
 
@@ -132,6 +236,9 @@ class Market:
     A tradable market on an Exchange.
     """
 
+    __slots__ = ('exchange', 'base', 'quote', 'code', 'api_name', 'log', 'trade_cache',
+                 'last_stored_trade_id', 'last_cached_trade_id', 'not_cached', 'trade_window')
+
     def __init__(self, exchange, base, quote, api_name):
         self.exchange = exchange
         self.base = base
@@ -140,41 +247,32 @@ class Market:
         self.api_name = api_name
 
         self.log = logging.getLogger(self.code)
+        self.log.addFilter(market_log_filter)
 
-    async def sync_db(self):
-        res = await self.init_trade_table()
-        self.last_stored_trade_id = res[0]
-        self.last_cached_trade_id = res[1]
-        self.not_cached = res[2]
+    async def load_sync_state(self):
+        "Reloads the sync state of the market from the database."
+        res = await fs.ROOT.Sys.collector.db.fetchrow(sync_state_query, [self.code])
+        self.set_sync_state(res)
 
-    async def init_trade_table(self):
+    def set_sync_state(self, res):
         """
-        Initializes trade table for the market.
+        Sets the sync cursors of the market from its row in the market table and seeds its trade
+        window with the last stored trades.
         """
-        db = fs.ROOT.Sys.collector.db
-
-        # Init trade table for market
-        if not await db.table_exists(self.code):
-            self.log.info("Market table doesn't exist. Creating it.")
-            await db.execute("""CREATE TABLE {} ( price      FLOAT8,
-                                                  volume     FLOAT8,
-                                                  time       TIMESTAMP,
-                                                  is_buy     BOOL,
-                                                  is_limit   BOOL )""".format(self.code))
-
-        # Init trade cache dir
+        self.last_stored_trade_id = res['last_stored_trade_id']
+        self.last_cached_trade_id = res['last_cached_trade_id']
+        self.not_cached = res['not_cached']
+
+        self.trade_window = fs.ROOT.Sys.collector.TradeWindow()
+        self.trade_window.seed(tuple(t) for t in json.loads(res['last_trades'] or '[]'))
+
+    def init_trade_cache(self):
+        "Initializes the trade cache dir of the market."
         self.trade_cache = os.path.join(fs.ROOT.Sys.collector.trade_cache, self.code)
         if not os.path.isdir(self.trade_cache):
             self.log.info("Trade cache dir %s doesn't exists. Creating it.", self.trade_cache)
             os.makedirs(self.trade_cache)
 
-        # The next query only runs if market row doesn't exists yet.
-        await db.execute("""INSERT INTO market (code, last_stored_trade_id, last_cached_trade_id, not_cached) VALUES ($1, '0', '0', 0)
-                             ON CONFLICT DO NOTHING;""", self.code)
-        res = await db.fetchrow("""SELECT last_stored_trade_id, last_cached_trade_id, not_cached
-                                     FROM market WHERE code=$1;""", self.code)
-        return res
-
     def __str__(self):
         return "{}".format(self.code)
 
@@ -183,6 +281,45 @@ class Market:
                                                                    self.quote)
 
 
+sync_state_query = """SELECT code, last_stored_trade_id, last_cached_trade_id, not_cached,
+                             last_trades
+                        FROM market WHERE code = ANY($1::text[]);"""
+
+
+async def sync_markets(markets):
+    """
+    Initializes the trade tables and loads the sync state of the markets. Every query covers all
+    the markets, so the number of database round-trips doesn't depend on the number of markets.
+    """
+    if not markets:
+        return
+    codes = [m.code for m in markets]
+
+    async with fs.ROOT.Sys.collector.db.pool.acquire() as con:
+        res = await con.fetch("""SELECT code FROM unnest($1::text[]) AS code
+                                  WHERE to_regclass('public.' || code) IS NULL;""", codes)
+        missing = {r['code'] for r in res}
+        if missing:
+            await con.execute(''.join("""CREATE TABLE {} ( price      FLOAT8,
+                                                          volume     FLOAT8,
+                                                          time       TIMESTAMP,
+                                                          is_buy     BOOL,
+                                                          is_limit   BOOL );""".format(code)
+                                      for code in missing))
+
+        # Only inserts the market rows which don't exist yet.
+        await con.execute("""INSERT INTO market (code, last_stored_trade_id, last_cached_trade_id, not_cached)
+                                  SELECT code, '0', '0', 0 FROM unnest($1::text[]) AS code
+                             ON CONFLICT DO NOTHING;""", codes)
+        rows = {r['code']: r for r in await con.fetch(sync_state_query, codes)}
+
+    for market in markets:
+        if market.code in missing:
+            market.log.info("Market table doesn't exist. Created it.")
+        market.init_trade_cache()
+        market.set_sync_state(rows[market.code])
+
+
 # CLI functions
 
 
@@ -201,10 +338,12 @@ class Database:
 
     async def create_pool(self):
         "Creates a connection pool for the database."
+        import asyncpg
         return await asyncpg.create_pool('postgresql://' + self.conn_string)
 
     async def connect_or_create(self):
         "Connects to exiting database or creates it."
+        import asyncpg
         # Connect to an 'admin' database that's surely exists.
         admin_conn = await asyncpg.connect(
                 'postgresql://' + self.server + '/' + fs.ROOT.Config.admin_database)
@@ -218,7 +357,7 @@ class Database:
 
             self.pool = await self.create_pool()
             async with self.pool.acquire() as con:
-                await con.execute(init_query)
+                await con.execute(self.init_query)
 
             log.info("New database and connection pool created.")
         else:
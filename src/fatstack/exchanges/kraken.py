@@ -1,7 +1,5 @@
 import fatstack as fs
-import logging, asyncio, datetime, math
-import pandas as pd
-import krakenex    # TO DO: Remove this from here.
+import logging, asyncio, datetime
 
 
 class KRAKENApiError(Exception):
@@ -25,11 +23,20 @@ class KRAKEN(fs.core.Exchange):
             for alt in alts:
                 self.alt_names_map[alt] = code
 
-        self.api = krakenex.API()
+        self._api = None
         self.api_call_rate_limit = 6
         self.trade_block_len = 1000
 
-        self.last_api_call = asyncio.get_event_loop().time()
+        # The first API call is never delayed.
+        self.last_api_call = float('-inf')
+
+    @property
+    def api(self):
+        "The krakenex client. It's only imported when a process talks to the exchange."
+        if self._api is None:
+            import krakenex
+            self._api = krakenex.API()
+        return self._api
 
     async def get_markets(self, instruments):
         """
@@ -38,22 +45,31 @@ class KRAKEN(fs.core.Exchange):
         list.
         """
         insts = {i.code: i for i in instruments}
-        names = {i.code: i.code for i in instruments}
-        names.update(self.alt_names_map)
+        # Prefix index of every name of the instruments.
+        names = {code: code for code in insts}
+        names.update((alt, code) for alt, code in self.alt_names_map.items() if code in insts)
+        prefix_lens = sorted({len(name) for name in names})
 
-        pairs = self.api.query_public('AssetPairs')['result']
+        async def query_asset_pairs():
+            loop = asyncio.get_event_loop()
+            res = await loop.run_in_executor(None, self.api.query_public, 'AssetPairs')
+            # Failed responses must not be cached.
+            if len(res['error']) != 0:
+                raise KRAKENApiError(res['error'])
+            return res
 
-        markets = []
-        for pair in pairs:
-            for alt, code in names.items():
-                if pair.startswith(alt) and code in insts:
-                    base = code
-                    quote = pair[len(alt):]
-                    if quote in names and names[quote] in insts:
-                        market = fs.core.Market(self, insts[base], insts[names[quote]], pair)
-                        await market.sync_db()
-                        markets.append(market)
+        pairs = await self.cached_query('asset_pairs', query_asset_pairs)
 
+        markets = []
+        for pair in pairs['result']:
+            for prefix_len in prefix_lens:
+                base = names.get(pair[:prefix_len])
+                quote = names.get(pair[prefix_len:])
+                if base and quote:
+                    markets.append(fs.core.Market(self, insts[base], insts[quote], pair))
+                    break
+
+        await fs.core.sync_markets(markets)
         return markets
 
     def trade_id_to_time(self, trade_id):
@@ -67,7 +83,7 @@ class KRAKEN(fs.core.Exchange):
         loop = asyncio.get_event_loop()
         delta = loop.time() - self.last_api_call
 
-        self.log.debug("Schedueling delta: {:.3f}".format(delta))
+        self.log.debug("Schedueling delta: %.3f", delta)
 
         if delta < self.api_call_rate_limit:
             self.last_api_call += self.api_call_rate_limit
@@ -86,16 +102,13 @@ class KRAKEN(fs.core.Exchange):
         return json_block
 
     def get_trades_from_json(self, trade_block):
-        trade_block.last = trade_block.json_block['result']['last']
-        trade_block.json_trades = trade_block.json_block['result'][trade_block.market.api_name]
-
-        trades = pd.DataFrame(
-            trade_block.json_trades, columns=['price', 'volume', 'time', 'buy', 'limit', 'misc'])
-        del trades['misc']
-        trades['price'] = trades['price'].map(lambda x: math.log10(float(x)))
-        trades['volume'] = trades['volume'].map(lambda x: float(x))
-        trades['time'] = trades['time'].map(lambda x: datetime.datetime.utcfromtimestamp(x))
-        trades['buy'] = trades['buy'].map(lambda x: x is 'b')
-        trades['limit'] = trades['limit'].map(lambda x: x is 'l')
-
-        trade_block.trades = trades
+        result = trade_block.json_block['result']
+        trade_block.last = result['last']
+        json_trades = result[trade_block.market.api_name]
+
+        trade_block.size = len(json_trades)
+        trade_block.price.extend(float(t[0]) for t in json_trades)
+        trade_block.volume.extend(float(t[1]) for t in json_trades)
+        trade_block.time.extend(t[2] for t in json_trades)
+        trade_block.buy.extend(t[3] == 'b' for t in json_trades)
+        trade_block.limit.extend(t[4] == 'l' for t in json_trades)
@@ -4,6 +4,8 @@ import fatstack
 class BTC(fatstack.core.Instrument):
     "The bitcoin cryptocurrency. See https://bitcoin.org for more."
 
+    __slots__ = ()
+
     def __init__(self):
         self.code = self.__class__.__name__
         self.name = 'bitcoin'
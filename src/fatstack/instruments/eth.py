@@ -4,6 +4,8 @@ import fatstack
 class ETH(fatstack.core.Instrument):
     "The ether cryptocurrency."
 
+    __slots__ = ()
+
     def __init__(self):
         self.code = self.__class__.__name__
         self.name = 'ether'
@@ -4,6 +4,8 @@ import fatstack
 class USD(fatstack.core.Instrument):
     "USA dollar."
 
+    __slots__ = ()
+
     def __init__(self):
         self.code = self.__class__.__name__
         self.name = 'dollar'